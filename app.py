@@ -1,87 +1,534 @@
 # app.py - Discord Broadcast Bot Backend
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
 import discord
+import aiohttp
 import asyncio
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import numpy as np
+import orjson
+import os
+import queue
+from pyroaring import BitMap64
 import time
 import threading
 
+# Log records are handed to a queue and written out by a listener thread,
+# so logging on the send path never blocks the event loop on stdout.
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+
 app = Flask(__name__)
 
+# A single long-lived event loop, running in its own thread, that owns every bot client.
+# Flask's async views run each request in a throwaway loop, so all Discord work is handed
+# to this loop instead of being awaited directly.
+_BG_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_BG_LOOP.run_forever, name="discord-bots", daemon=True).start()
+
+def submit(coro):
+    """
+    Schedules a coroutine on the bot event loop and returns a concurrent.futures.Future.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _BG_LOOP)
+
 # Dictionary to store active bot clients and their cooldowns
 # In a real application, you might want a more persistent storage for tokens
 # and manage multiple bots more robustly.
+# Reads are plain lock-free lookups; logins for a token are serialized by _login_locks.
 active_bots = {}
+# One lock per bot token so concurrent status checks don't log the same bot in twice.
+# An entry only exists while some request holds or waits for its lock, and is keyed by a
+# hash of the token, so failed logins with invalid tokens leave nothing behind.
+# Only touched from the bot event loop, so updating the dict needs no extra locking.
+# Format: {token_hash: [asyncio.Lock, number of requests holding or waiting for it]}
+_login_locks = {}
+# Broadcasts in progress, so identical requests share one run instead of starting another.
+# Format: {(bot_token, message_digest): concurrent.futures.Future resolving to the summary record}
+_inflight_broadcasts = {}
+_inflight_lock = threading.Lock()
 # Cooldowns per user/channel for broadcasting
-# Format: {bot_token: {recipient_id: last_sent_timestamp}}
+# When REDIS_URL is set, cooldowns are shared by every server process through Redis keys
+# that expire on their own; otherwise each process keeps them in memory.
+REDIS_URL = os.environ.get('REDIS_URL')
+# Shared by all bots; only used from the bot event loop, so its connections belong to that loop
+# redis is only needed (and imported) when REDIS_URL is set
+if REDIS_URL:
+    import redis.asyncio as redis
+    redis_client = redis.from_url(REDIS_URL)
+else:
+    redis_client = None
+# Format: {bot_token: CooldownTable} (only used without Redis)
 broadcast_cooldowns = {}
 COOLDOWN_SECONDS = 1  # 1 second cooldown between messages to each recipient
+COOLDOWN_NS = COOLDOWN_SECONDS * 1_000_000_000
+NEVER_SENT_NS = -COOLDOWN_NS  # Timestamp of recipients that never got a message; always off cooldown
+MAX_INFLIGHT_SENDS = 8  # Maximum number of DMs being sent at the same time during a broadcast
+# Client-side cap on broadcast sends per bot (sends per second, burst size).
+# Discord's global limit is 50 requests per second per bot, and a DM to a user whose DM channel
+# isn't cached yet costs two requests (open the channel, post the message), so 25 sends per
+# second stays under it. Per-channel limits don't matter here: every DM goes to a different
+# channel, and discord.py already tracks those buckets and retries 429 responses itself.
+SEND_RATE_LIMIT = (25, 25)
+BOT_CONNECTION_LIMIT = 100  # Maximum open HTTPS connections per bot client
+# Gateway intents for every bot client, built once
+INTENTS = discord.Intents.default()
+INTENTS.message_content = True # Required for message content
+INTENTS.members = True # Required to get members for broadcasting
+INTENTS.presences = False # Not strictly needed for this bot, can be False for performance
+STREAM_BATCH_SIZE = 100  # Progress records written per chunk of the /api/broadcast response
+STREAM_FLUSH_SECONDS = 1  # Flush a partial chunk if no progress arrived for this long
 
 # --- Helper functions for Discord Bot ---
 
+class AsyncTokenBucket:
+    """
+    A simple token bucket: allows `rate` acquisitions per second with bursts up to `capacity`.
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock() # Waiters are served one at a time, in arrival order
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """
+        Waits until a token is available and consumes it.
+        """
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+class CooldownTable:
+    """
+    Last-sent timestamps (time.monotonic_ns(), so wall-clock jumps can't skip or extend
+    cooldowns) for one bot's recipients.
+    Recipient IDs are kept in a sorted uint64 array with their timestamps in a parallel int64
+    array, so looking up and filtering a whole batch of recipients is done with vectorized
+    NumPy operations rather than per-recipient Python code.
+    """
+    def __init__(self):
+        self._ids = np.empty(0, dtype=np.uint64)
+        self._timestamps = np.empty(0, dtype=np.int64)
+
+    def _slots_for(self, ids):
+        """
+        Returns the slot of every recipient in `ids` (no duplicates), adding new recipients to the table.
+        """
+        slots = np.searchsorted(self._ids, ids)
+        known = slots < self._ids.size
+        known[known] = self._ids[slots[known]] == ids[known]
+        if not known.all():
+            new_ids = np.sort(ids[~known])
+            positions = np.searchsorted(self._ids, new_ids)
+            self._ids = np.insert(self._ids, positions, new_ids)
+            self._timestamps = np.insert(self._timestamps, positions, NEVER_SENT_NS)
+            slots = np.searchsorted(self._ids, ids)
+        return slots
+
+    async def claim(self, recipient_ids: BitMap64):
+        """
+        Starts the cooldown of every recipient whose previous one has expired
+        and returns those recipients.
+        """
+        now_ns = time.monotonic_ns()
+        ids = np.frombuffer(recipient_ids.to_array(), dtype=np.uint64)
+        slots = self._slots_for(ids)
+        eligible = (now_ns - self._timestamps[slots]) >= COOLDOWN_NS
+        self._timestamps[slots[eligible]] = now_ns
+        return ids[eligible].tolist()
+
+    async def release(self, recipient_ids: list):
+        """
+        Clears the cooldown of recipients whose message could not be delivered.
+        """
+        ids = np.fromiter(recipient_ids, dtype=np.uint64, count=len(recipient_ids))
+        self._timestamps[self._slots_for(ids)] = NEVER_SENT_NS
+
+class RedisCooldownStore:
+    """
+    Cooldowns kept in Redis as one expiring key per (bot, recipient), shared across processes.
+    """
+    def __init__(self, bot_token: str):
+        # Don't leak bot tokens into the Redis keyspace
+        self._prefix = f"cd:{hashlib.sha256(bot_token.encode()).hexdigest()[:16]}:"
+
+    async def claim(self, recipient_ids: BitMap64):
+        """
+        Sets a cooldown key for every recipient that doesn't have one yet (one round trip)
+        and returns those recipients.
+        """
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for recipient_id in recipient_ids:
+                pipe.set(f"{self._prefix}{recipient_id}", 1, nx=True, px=COOLDOWN_SECONDS * 1000)
+            acquired = await pipe.execute()
+        return [recipient_id for recipient_id, ok in zip(recipient_ids, acquired) if ok]
+
+    async def release(self, recipient_ids: list):
+        """
+        Clears the cooldown of recipients whose message could not be delivered.
+        """
+        if recipient_ids:
+            await redis_client.delete(*(f"{self._prefix}{recipient_id}" for recipient_id in recipient_ids))
+
+def get_cooldown_store(bot_token: str):
+    """
+    Returns the cooldown store to use for a broadcast by the given bot.
+    """
+    if REDIS_URL:
+        return RedisCooldownStore(bot_token)
+    # Initialize cooldowns for this bot if not present
+    return broadcast_cooldowns.setdefault(bot_token, CooldownTable())
+
+def collect_guild_user_ids(guild):
+    """
+    Returns the IDs of all non-bot members cached for a guild.
+    """
+    return BitMap64(member.id for member in guild.members if not member.bot) # Don't send messages to other bots
+
+def collect_dm_user_ids(private_channels):
+    """
+    Returns the IDs of non-bot users the bot has an open DM channel with.
+    """
+    return BitMap64(
+        channel.recipient.id for channel in private_channels
+        if isinstance(channel, discord.DMChannel) and not channel.recipient.bot
+    )
+
 class DiscordBotClient(discord.Client):
     """
     A custom Discord client to handle bot operations.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.is_ready = asyncio.Event() # Event to signal when bot is ready
         self.token = None # Store the token for later use
+        self.runner = None # Task running connect() on the bot event loop
+        self._closer = None # Task closing the client after connect() exits; kept so it isn't garbage-collected
+        self._ratelimit = AsyncTokenBucket(*SEND_RATE_LIMIT) # One bucket per bot token
+        # IDs of non-bot members across all guilds, kept up to date by the member/guild events
+        # below so broadcasts don't have to rescan every guild.
+        # Stored as a compressed bitmap: far smaller than a set of ints for large member counts.
+        self.human_user_ids = BitMap64()
+        # Changes made while a rebuild is scanning, replayed onto its result
+        self._added_during_rebuild = None
+        self._removed_during_rebuild = None
+        self.members_cached = asyncio.Event() # Set once human_user_ids has been built the first time
+
+    async def _rebuild_human_user_ids(self):
+        # All bots share one event loop, so scan the member caches in worker threads
+        # instead of stalling every bot's gateway while large guilds are walked
+        self._added_during_rebuild = BitMap64()
+        self._removed_during_rebuild = BitMap64()
+        scans = await asyncio.gather(*(asyncio.to_thread(collect_guild_user_ids, guild) for guild in self.guilds))
+        human_user_ids = BitMap64.union(*scans)
+        human_user_ids.difference_update(self._removed_during_rebuild)
+        human_user_ids.update(self._added_during_rebuild)
+        self.human_user_ids = human_user_ids
+        self._added_during_rebuild = None
+        self._removed_during_rebuild = None
+        self.members_cached.set()
+
+    def _add_human_ids(self, user_ids):
+        """
+        Adds user IDs to human_user_ids, and to the changes replayed by a running rebuild.
+        """
+        self.human_user_ids.update(user_ids)
+        if self._added_during_rebuild is not None:
+            self._added_during_rebuild.update(user_ids)
+            self._removed_during_rebuild.difference_update(user_ids)
+
+    def _remove_human_ids(self, user_ids):
+        """
+        Removes user IDs from human_user_ids, and from the result of a running rebuild.
+        """
+        self.human_user_ids.difference_update(user_ids)
+        if self._removed_during_rebuild is not None:
+            self._removed_during_rebuild.update(user_ids)
+            self._added_during_rebuild.difference_update(user_ids)
+
+    def _ids_only_in(self, guild):
+        """
+        Returns the IDs of non-bot members of `guild` that no other guild of the bot has.
+        """
+        guilds = self.guilds
+        return BitMap64(
+            member.id for member in guild.members
+            if not member.bot and not any(other.get_member(member.id) for other in guilds)
+        )
+
+    def start_runner(self):
+        """
+        Runs connect() in a task on the current event loop.
+        """
+        self.runner = asyncio.create_task(self.connect())
+        self.runner.add_done_callback(self._on_runner_done)
+
+    def _on_runner_done(self, runner):
+        """
+        Logs why connect() stopped and closes the client so it no longer reports being ready.
+        """
+        if not runner.cancelled() and runner.exception() is not None:
+            log.warning("Bot %s stopped running: %s", self.user, runner.exception())
+        if not self.is_closed():
+            self._closer = asyncio.create_task(self.close())
 
     async def on_ready(self):
         """
         Called when the bot successfully connects to Discord.
         """
-        print(f'Logged in as {self.user} (ID: {self.user.id})')
-        self.is_ready.set() # Signal that the bot is ready
+        log.info('Logged in as %s (ID: %s)', self.user, self.user.id)
+        await self._rebuild_human_user_ids()
+
+    async def on_member_join(self, member):
+        if not member.bot:
+            self._add_human_ids(BitMap64((member.id,)))
+
+    async def on_member_remove(self, member):
+        # The user may still share another guild with the bot
+        if not any(guild.get_member(member.id) for guild in self.guilds):
+            self._remove_human_ids(BitMap64((member.id,)))
 
-    async def on_connect(self):
+    async def on_guild_join(self, guild):
+        # Compute the IDs before touching human_user_ids: a rebuild may replace it during the scan
+        user_ids = await asyncio.to_thread(collect_guild_user_ids, guild)
+        self._add_human_ids(user_ids)
+
+    async def on_guild_remove(self, guild):
+        # Only drop the members the bot no longer shares any guild with
+        user_ids = await asyncio.to_thread(self._ids_only_in, guild)
+        self._remove_human_ids(user_ids)
+
+    async def _send_rate_limited(self, target, message_content: str):
         """
-        Called when the bot connects to Discord.
+        Sends a message once the bot's send bucket allows it.
         """
-        print(f'Bot connected to Discord.')
-        self.is_ready.clear() # Clear the ready state on reconnect/connect
+        await self._ratelimit.acquire()
+        return await target.send(message_content)
 
-    async def on_disconnect(self):
+    def resolve_recipient(self, recipient_id: int):
         """
-        Called when the bot disconnects from Discord.
+        Returns the cached user a message to `recipient_id` should be sent to, or None.
+        Broadcast recipients are always user IDs (guild members and DM partners), so
+        there is no channel lookup.
         """
-        print(f'Bot disconnected from Discord.')
-        self.is_ready.clear() # Clear the ready state on disconnect
+        user = self.get_user(recipient_id)
+        if user is None:
+            log.warning("Could not find user with ID: %s", recipient_id)
+        return user
 
-    async def send_broadcast_message(self, recipient_id: int, message_content: str):
+    async def send_to(self, target: discord.abc.Messageable, message_content: str):
         """
-        Sends a message to a specific user or channel.
+        Sends a message to an already resolved user.
         """
         try:
-            # Try to get a user first
-            user = self.get_user(recipient_id)
-            if user:
-                await user.send(message_content)
-                print(f"Sent DM to user {user.name} ({recipient_id}): {message_content}")
-                return True
-            
-            # If not a user, try to get a channel
-            channel = self.get_channel(recipient_id)
-            if channel:
-                if isinstance(channel, discord.TextChannel) or isinstance(channel, discord.DMChannel):
-                    await channel.send(message_content)
-                    print(f"Sent message to channel {channel.name} ({recipient_id}): {message_content}")
-                    return True
-                else:
-                    print(f"Recipient {recipient_id} is a voice or other unsupported channel type.")
-                    return False
-            else:
-                print(f"Could not find user or channel with ID: {recipient_id}")
-                return False
+            await self._send_rate_limited(target, message_content)
+            log.debug("Sent message to %s (%s)", target, target.id)
+            return True
         except discord.errors.Forbidden:
-            print(f"Bot does not have permission to send messages to {recipient_id}.")
+            log.warning("Bot does not have permission to send messages to %s.", target.id)
             return False
         except Exception as e:
-            print(f"Error sending message to {recipient_id}: {e}")
+            log.warning("Error sending message to %s: %s", target.id, e)
             return False
 
+# --- Bot event loop coroutines (run through submit()) ---
+
+async def login_bot(bot_token: str, intents: discord.Intents):
+    """
+    Creates a bot client, logs it in, connects it and waits for it to become ready and
+    for its member cache to be built (timeout after 10 seconds).
+    Runs on the bot event loop so the client and its events are bound to that loop.
+    """
+    # Cap the client's sockets and cache DNS lookups for Discord's hosts
+    connector = aiohttp.TCPConnector(limit=BOT_CONNECTION_LIMIT, ttl_dns_cache=300)
+    bot_client = DiscordBotClient(intents=intents, connector=connector)
+    bot_client.token = bot_token # Store token for this client instance
+    try:
+        await bot_client.login(bot_token) # Raises LoginFailure for invalid tokens
+        bot_client.start_runner()
+        # discord.py reports ready before on_ready has built the member cache, so wait for that
+        ready = asyncio.create_task(bot_client.members_cached.wait())
+
+        done, _ = await asyncio.wait({bot_client.runner, ready}, timeout=10.0, return_when=asyncio.FIRST_COMPLETED)
+        if ready in done:
+            return bot_client
+
+        ready.cancel()
+        if bot_client.runner in done:
+            bot_client.runner.result() # Re-raise the connection error
+        raise asyncio.TimeoutError()
+    except BaseException:
+        # The bot failed to log in or didn't become ready in time: stop the client
+        try:
+            await bot_client.close()
+        except Exception as e:
+            log.warning("Error closing bot client that failed to become ready: %s", e)
+        raise
+
+async def ensure_bot_logged_in(bot_token: str, intents: discord.Intents):
+    """
+    Returns (bot_client, logged_in_now) for the token, logging the bot in unless
+    another request already did while this one was waiting for the lock.
+    At most one open client exists per token.
+    """
+    lock_key = hashlib.sha256(bot_token.encode()).digest()
+    login_lock = _login_locks.setdefault(lock_key, [asyncio.Lock(), 0])
+    login_lock[1] += 1
+    try:
+        async with login_lock[0]:
+            bot_client = active_bots.get(bot_token)
+            if bot_client:
+                # Reuse the existing client (and its connections) while it is still running;
+                # connect() keeps reconnecting on its own until it gives up
+                if not bot_client.runner.done():
+                    return bot_client, False
+                # connect() has exited, so the client is dead: close it before logging in anew
+                log.warning("Bot with token %s... stopped running, logging in anew.", bot_token[:5])
+                active_bots.pop(bot_token, None)
+                try:
+                    await bot_client.close()
+                except Exception as e:
+                    log.warning("Error closing stopped bot client: %s", e)
+            bot_client = await login_bot(bot_token, intents)
+            active_bots[bot_token] = bot_client
+            return bot_client, True
+    finally:
+        login_lock[1] -= 1
+        if not login_lock[1]:
+            del _login_locks[lock_key]
+
+async def run_broadcast(bot_client: DiscordBotClient, bot_token: str, user_ids: BitMap64, message_content: str, results: queue.Queue, consumer_gone: threading.Event):
+    """
+    Sends the message to every recipient off cooldown.
+    Puts a progress record on `results` as each send completes, then a summary record,
+    then None to mark the end of the stream. Returns the summary record.
+    Progress records stop once `consumer_gone` is set, so a disconnected client's queue
+    doesn't keep growing while the broadcast carries on.
+    """
+    try:
+        cooldowns = get_cooldown_store(bot_token)
+        # Claim the recipients that are off cooldown before dispatching anything
+        eligible_user_ids = await cooldowns.claim(user_ids)
+        skipped_cooldown_count = len(user_ids) - len(eligible_user_ids)
+        if skipped_cooldown_count:
+            log.info("Skipping %d users due to cooldown.", skipped_cooldown_count)
+
+        # A fixed pool of workers pulls recipients from one shared iterator, so only
+        # MAX_INFLIGHT_SENDS sends (and tasks) exist at a time however many recipients there are
+        pending_user_ids = iter(eligible_user_ids)
+        in_flight_user_ids = set()
+        failed_user_ids = []
+
+        async def send_worker():
+            for user_id in pending_user_ids:
+                in_flight_user_ids.add(user_id)
+                # Each recipient is resolved once, right before its send
+                target = bot_client.resolve_recipient(user_id)
+                success = target is not None and await bot_client.send_to(target, message_content)
+                in_flight_user_ids.discard(user_id)
+                if not success:
+                    failed_user_ids.append(user_id)
+                if not consumer_gone.is_set():
+                    results.put({"type": "progress", "user_id": str(user_id), "status": "sent" if success else "failed"})
+
+        workers = [asyncio.create_task(send_worker()) for _ in range(min(MAX_INFLIGHT_SENDS, len(eligible_user_ids)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # On error, stop the remaining workers and give back every claimed recipient
+            # that didn't receive the message
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await cooldowns.release(failed_user_ids + list(in_flight_user_ids) + list(pending_user_ids))
+
+        failed_count = len(failed_user_ids)
+        sent_count = len(eligible_user_ids) - failed_count
+        summary = {
+            "type": "summary",
+            "status": "success",
+            "message": f"تم محاولة بث الرسالة إلى {len(user_ids)} مستخدمين. تم الإرسال إلى {sent_count}، فشل {failed_count}، تم تخطي {skipped_cooldown_count} بسبب فترة التهدئة.",
+            "sent_count": sent_count,
+            "failed_count": failed_count,
+            "skipped_cooldown_count": skipped_cooldown_count
+        }
+    except Exception as e:
+        log.exception("An unexpected error occurred during broadcast: %s", e)
+        summary = {"type": "summary", "status": "error", "message": f"حدث خطأ غير متوقع: {str(e)}"}
+    results.put(summary)
+    results.put(None)
+    return summary
+
+def stream_records(results: queue.Queue, consumer_gone: threading.Event):
+    """
+    Yields the records put on `results` as NDJSON, several lines per chunk.
+    A chunk is flushed once it holds STREAM_BATCH_SIZE records, or when no new record
+    arrived for STREAM_FLUSH_SECONDS so slow broadcasts still show progress.
+    Sets `consumer_gone` when the stream ends or the client disconnects.
+    """
+    buffer = []
+    try:
+        while True:
+            try:
+                record = results.get(timeout=STREAM_FLUSH_SECONDS)
+            except queue.Empty:
+                if buffer:
+                    yield b"\n".join(buffer) + b"\n"
+                    buffer = []
+                continue
+            if record is None:
+                break
+            buffer.append(orjson.dumps(record))
+            if len(buffer) >= STREAM_BATCH_SIZE:
+                yield b"\n".join(buffer) + b"\n"
+                buffer = []
+        if buffer:
+            yield b"\n".join(buffer) + b"\n"
+    finally:
+        consumer_gone.set()
+
 # --- Flask Endpoints ---
 
+# Bodies of fixed error responses, serialized once at startup
+_ERR_TOKEN_REQUIRED = orjson.dumps({"status": "error", "message": "Bot token is required."})
+_ERR_LOGIN_TIMEOUT = orjson.dumps({"status": "error", "message": "فشل تسجيل دخول البوت: مهلة."})
+_ERR_INVALID_TOKEN = orjson.dumps({"status": "error", "message": "فشل تسجيل دخول البوت: رمز غير صالح."})
+_ERR_TOKEN_AND_MESSAGE_REQUIRED = orjson.dumps({"status": "error", "message": "Bot token and message are required."})
+_ERR_BOT_NOT_READY = orjson.dumps({"status": "error", "message": "البوت غير متصل أو غير جاهز. يرجى التحقق من حالته أولاً."})
+# Answered right away to a request repeating a running broadcast, instead of holding a
+# server thread until that broadcast's summary is ready
+_JOINED_BROADCAST = orjson.dumps({"type": "joined", "status": "success", "message": "البث نفسه قيد التنفيذ بالفعل، لن يتم إرسال الرسالة مرة أخرى."}) + b"\n"
+_ERR_NO_RECIPIENTS = orjson.dumps({"status": "error", "message": "لم يتم العثور على مستخدمين للبث إليهم. تأكد من أن البوت في خوادم ولديه صلاحيات 'أعضاء الخادم'."})
+
+def json_response(payload, status: int = 200):
+    """
+    Builds a JSON response serialized with orjson.
+    `payload` may also be an already serialized body (bytes).
+    """
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
+    return app.response_class(body, status=status, mimetype='application/json')
+
 @app.route('/')
 def index():
     """
@@ -99,155 +546,102 @@ async def check_bot_status():
     bot_token = data.get('botToken')
 
     if not bot_token:
-        return jsonify({"status": "error", "message": "Bot token is required."}), 400
+        return json_response(_ERR_TOKEN_REQUIRED, 400)
 
-    # Check if bot is already active and ready
-    if bot_token in active_bots and active_bots[bot_token].is_ready.is_set():
-        bot_client = active_bots[bot_token]
-        return jsonify({
+    # Check if bot is already active and ready (lock-free fast path)
+    bot_client = active_bots.get(bot_token)
+    if bot_client and bot_client.is_ready() and bot_client.members_cached.is_set():
+        return json_response({
             "status": "success",
             "message": "Bot is already logged in.",
             "username": bot_client.user.name,
             "discriminator": bot_client.user.discriminator,
             "id": str(bot_client.user.id)
-        }), 200
+        })
 
     # If not active or not ready, try to log in
     try:
-        # Create a new bot client instance
-        intents = discord.Intents.default()
-        intents.message_content = True # Required for message content
-        intents.members = True # Required to get members for broadcasting
-        intents.presences = False # Not strictly needed for this bot, can be False for performance
-        
-        bot_client = DiscordBotClient(intents=intents)
-        bot_client.token = bot_token # Store token for this client instance
-
-        # Use a separate thread to run the bot, as run() is blocking
-        bot_thread = threading.Thread(target=lambda: asyncio.run(bot_client.start(bot_token)))
-        bot_thread.daemon = True # Allow the thread to exit when the main program exits
-        bot_thread.start()
-
-        # Wait for the bot to become ready (timeout after 10 seconds)
+        # Start the bot on the bot event loop and wait for it to become ready
         try:
-            await asyncio.wait_for(bot_client.is_ready.wait(), timeout=10.0)
-            active_bots[bot_token] = bot_client
-            return jsonify({
-                "status": "success",
-                "message": "Bot logged in successfully.",
-                "username": bot_client.user.name,
-                "discriminator": bot_client.user.discriminator,
-                "id": str(bot_client.user.id)
-            }), 200
+            bot_client, logged_in_now = await asyncio.wrap_future(submit(ensure_bot_logged_in(bot_token, INTENTS)))
         except asyncio.TimeoutError:
-            print(f"Bot with token {bot_token[:5]}... timed out during login.")
-            # If timeout, stop the bot client and remove it
-            if bot_client.is_ready.is_set(): # Check if it became ready just before timeout
-                active_bots[bot_token] = bot_client
-                return jsonify({
-                    "status": "success",
-                    "message": "Bot logged in successfully (after timeout wait).",
-                    "username": bot_client.user.name,
-                    "discriminator": bot_client.user.discriminator,
-                    "id": str(bot_client.user.id)
-                }), 200
-            else:
-                # Attempt to close the client gracefully if it didn't become ready
-                try:
-                    await bot_client.close()
-                except Exception as e:
-                    print(f"Error closing timed out bot client: {e}")
-                return jsonify({"status": "error", "message": "فشل تسجيل دخول البوت: مهلة."}), 500
+            log.warning("Bot with token %s... timed out during login.", bot_token[:5])
+            return json_response(_ERR_LOGIN_TIMEOUT, 500)
+
+        return json_response({
+            "status": "success",
+            "message": "Bot logged in successfully." if logged_in_now else "Bot is already logged in.",
+            "username": bot_client.user.name,
+            "discriminator": bot_client.user.discriminator,
+            "id": str(bot_client.user.id)
+        })
 
     except discord.errors.LoginFailure:
-        print(f"Invalid token provided: {bot_token[:5]}...")
-        return jsonify({"status": "error", "message": "فشل تسجيل دخول البوت: رمز غير صالح."}), 401
+        log.warning("Invalid token provided: %s...", bot_token[:5])
+        return json_response(_ERR_INVALID_TOKEN, 401)
     except Exception as e:
-        print(f"An unexpected error occurred during bot login: {e}")
-        return jsonify({"status": "error", "message": f"حدث خطأ غير متوقع: {str(e)}"}), 500
+        log.exception("An unexpected error occurred during bot login: %s", e)
+        return json_response({"status": "error", "message": f"حدث خطأ غير متوقع: {str(e)}"}, 500)
 
 @app.route('/api/broadcast', methods=['POST'])
 async def broadcast_message():
     """
     Endpoint to broadcast a message to all users in guilds the bot is in,
     with a cooldown per user.
+    Streams NDJSON: one progress record per send, then a summary record.
+    A request repeating a broadcast that is still running only receives a "joined" record.
     """
     data = request.json
     bot_token = data.get('botToken')
     message_content = data.get('message')
 
     if not bot_token or not message_content:
-        return jsonify({"status": "error", "message": "Bot token and message are required."}), 400
+        return json_response(_ERR_TOKEN_AND_MESSAGE_REQUIRED, 400)
 
     bot_client = active_bots.get(bot_token)
 
-    if not bot_client or not bot_client.is_ready.is_set():
-        return jsonify({"status": "error", "message": "البوت غير متصل أو غير جاهز. يرجى التحقق من حالته أولاً."}), 400
+    # Until the member cache is first built there would be no one to broadcast to
+    if not bot_client or not bot_client.is_ready() or not bot_client.members_cached.is_set():
+        return json_response(_ERR_BOT_NOT_READY, 400)
 
-    sent_count = 0
-    failed_count = 0
-    skipped_cooldown_count = 0
-    
-    # Initialize cooldowns for this bot if not present
-    if bot_token not in broadcast_cooldowns:
-        broadcast_cooldowns[bot_token] = {}
-
-    # Gather all unique user IDs from all guilds the bot is in
-    # Note: This requires the 'members' intent and for the bot to have 'Server Members Intent' enabled
-    # in the Discord Developer Portal for your bot.
-    unique_user_ids = set()
-    for guild in bot_client.guilds:
-        # Ensure 'members' intent is enabled and bot has permissions to see members
-        if bot_client.intents.members:
-            # Fetch members if not already cached (might be slow for large guilds)
-            # await guild.chunk() # Uncomment if you need to ensure all members are cached
-            for member in guild.members:
-                if not member.bot: # Don't send messages to other bots
-                    unique_user_ids.add(member.id)
-        else:
-            print(f"Warning: 'members' intent is not enabled for guild {guild.name}. Cannot fetch members.")
-            # If members intent is not enabled, you might only be able to DM users who have
-            # recently interacted with the bot or are in the bot's cache.
-            # For a broadcast, it's crucial to have the members intent.
-
-    # Also consider direct message channels if the bot has interacted with users directly
-    for dm_channel in bot_client.private_channels:
-        if isinstance(dm_channel, discord.DMChannel) and not dm_channel.recipient.bot:
-            unique_user_ids.add(dm_channel.recipient.id)
-
-    if not unique_user_ids:
-        return jsonify({"status": "error", "message": "لم يتم العثور على مستخدمين للبث إليهم. تأكد من أن البوت في خوادم ولديه صلاحيات 'أعضاء الخادم'."}), 404
-
-    current_time = time.time()
-    
-    # Send messages with cooldown
-    for user_id in list(unique_user_ids): # Iterate over a copy to avoid issues if set changes
-        last_sent_time = broadcast_cooldowns[bot_token].get(user_id, 0)
-        
-        if (current_time - last_sent_time) >= COOLDOWN_SECONDS:
-            success = await bot_client.send_broadcast_message(user_id, message_content)
-            if success:
-                sent_count += 1
-                broadcast_cooldowns[bot_token][user_id] = current_time
-            else:
-                failed_count += 1
-            await asyncio.sleep(0.1) # Small delay to avoid hitting Discord rate limits too quickly
-        else:
-            skipped_cooldown_count += 1
-            print(f"Skipping user {user_id} due to cooldown.")
-
-    return jsonify({
-        "status": "success",
-        "message": f"تم محاولة بث الرسالة إلى {len(unique_user_ids)} مستخدمين. تم الإرسال إلى {sent_count}، فشل {failed_count}، تم تخطي {skipped_cooldown_count} بسبب فترة التهدئة.",
-        "sent_count": sent_count,
-        "failed_count": failed_count,
-        "skipped_cooldown_count": skipped_cooldown_count
-    }), 200
+    # Identical broadcasts already in progress are joined instead of being started again
+    broadcast_key = (bot_token, hashlib.blake2b(message_content.encode(), digest_size=16).digest())
+    with _inflight_lock:
+        broadcast = _inflight_broadcasts.get(broadcast_key)
+        if broadcast is None:
+            # Gather all unique user IDs from all guilds the bot is in
+            # Note: This requires the 'members' intent and for the bot to have 'Server Members Intent' enabled
+            # in the Discord Developer Portal for your bot.
+            if not bot_client.intents.members:
+                log.warning("'members' intent is not enabled. Cannot fetch guild members.")
+                # If members intent is not enabled, you might only be able to DM users who have
+                # recently interacted with the bot or are in the bot's cache.
+                # For a broadcast, it's crucial to have the members intent.
+
+            # Also consider direct message channels if the bot has interacted with users directly
+            unique_user_ids = bot_client.human_user_ids | collect_dm_user_ids(bot_client.private_channels)
+
+            if not unique_user_ids:
+                return json_response(_ERR_NO_RECIPIENTS, 404)
+
+            # Stream progress back while the broadcast runs on the bot event loop
+            results = queue.Queue()
+            consumer_gone = threading.Event()
+            broadcast = submit(run_broadcast(bot_client, bot_token, unique_user_ids, message_content, results, consumer_gone))
+            _inflight_broadcasts[broadcast_key] = broadcast
+            broadcast.add_done_callback(lambda _: _inflight_broadcasts.pop(broadcast_key, None))
+            return Response(stream_records(results, consumer_gone), mimetype='application/x-ndjson')
+
+    log.info("Joining identical broadcast already in progress for bot %s...", bot_token[:5])
+    return Response(_JOINED_BROADCAST, mimetype='application/x-ndjson')
 
 if __name__ == '__main__':
-    # Run Flask app
-    # Use a separate thread for the Flask app to not block the main thread
-    # where the Discord bot's event loop will run.
-    # In a production environment, use a WSGI server like Gunicorn.
-    print("Starting Flask server...")
-    app.run(debug=True, port=5000, use_reloader=False) # use_reloader=False to prevent duplicate bot instances
+    # Serve the app with Hypercorn. Keep a single worker process: logged-in bots (active_bots)
+    # live in the worker's memory, so other workers would log the same bot in again.
+    # Requests are still handled concurrently on the worker's thread pool.
+    #   hypercorn app:app --bind 0.0.0.0:5000
+    log.info("Starting server...")
+    config = Config()
+    config.bind = ["127.0.0.1:5000"]
+    # WSGI mode runs each request on a thread pool, so a streaming broadcast doesn't block other requests
+    asyncio.run(serve(app, config, mode="wsgi"))